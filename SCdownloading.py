@@ -1,10 +1,15 @@
 import sclib
-import json
+import orjson
 import os
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.exceptions import ClientError
 
 
+# Resolving playlists is network-bound, so threads scale well until rate-limited
+MAX_PLAYLIST_WORKERS = 4
+
+
 def url_collection(playlist_urls, output_file):
     """
     Collect data from SoundCloud playlists and store permanent track URLs in a JSON file.
@@ -18,52 +23,66 @@ def url_collection(playlist_urls, output_file):
 
     # Ensure the file exists
     if not os.path.exists(output_file):
-        with open(output_file, "w") as f:
-            json.dump([], f)
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps([]))
 
     # Load existing data
-    with open(output_file, "r") as f:
-        all_tracks = json.load(f)
+    with open(output_file, "rb") as f:
+        all_tracks = orjson.loads(f.read())
+
+    # Tracks already collected, keyed by (title, artist) for constant-time duplicate checks
+    seen = {(track["title"], track["artist"]) for track in all_tracks}
 
-    # Process each playlist URL
-    for playlist_index, playlist_url in enumerate(playlist_urls, start=1):
+    def fetch_playlist(playlist_url):
+        """Resolve a playlist and return its title and track data, or None on failure."""
         try:
             playlist = client.resolve(playlist_url)
+        except Exception as e:
+            print(f"Error fetching playlist {playlist_url}: {e}")
+            return None
+
+        # sclib already resolves playlist tracks in batches, so no per-track request is needed
+        tracks = []
+        for track in playlist.tracks:
+            try:
+                tracks.append({
+                    "title": track.title,
+                    "artist": track.user["username"],
+                    "track_url": track.permalink_url,  # Store permanent track URL
+                    "duration": track.duration,
+                    "genre": track.genre,
+                })
+            except Exception as e:
+                print(f"    Error reading track {getattr(track, 'title', 'Unknown')}: {e}")
+        return playlist, tracks
+
+    # Resolve playlists concurrently, but merge them in playlist_urls order so the
+    # stored copy of a duplicate and the output order are the same on every run
+    with ThreadPoolExecutor(max_workers=MAX_PLAYLIST_WORKERS) as executor:
+        results = executor.map(fetch_playlist, playlist_urls)
+
+        for playlist_index, result in enumerate(results, start=1):
+            if result is None:
+                continue
+
+            playlist, tracks = result
             print(f"\nProcessing playlist {playlist_index}/{len(playlist_urls)}: {playlist.title} by {playlist.user['username']}")
-            print(f"Tracks in playlist: {len(playlist.tracks)}")
-
-            # Collect new track data
-            for track_index, track in enumerate(playlist.tracks, start=1):
-                print(f"  Processing track {track_index}/{len(playlist.tracks)}: {getattr(track, 'title', 'Unknown')}")
-
-                try:
-                    resolved_track = client.resolve(track.permalink_url)
-                    track_url = resolved_track.permalink_url
-                    new_track = {
-                        "title": resolved_track.title,
-                        "artist": resolved_track.user["username"],
-                        "track_url": track_url,  # Store permanent track URL
-                        "duration": resolved_track.duration,
-                        "genre": resolved_track.genre,
-                    }
-
-                    # Avoid duplicate entries
-                    if new_track not in all_tracks:
-                        all_tracks.append(new_track)
-                        print(f"    Fetched: {resolved_track.title}")
-                        print(f"    Track URL: {track_url}")
-
-                except Exception as e:
-                    print(f"    Error resolving track {getattr(track, 'title', 'Unknown')}: {e}")
+            print(f"Tracks in playlist: {len(tracks)}")
+
+            for new_track in tracks:
+                # Avoid duplicate entries
+                key = (new_track["title"], new_track["artist"])
+                if key not in seen:
+                    seen.add(key)
+                    all_tracks.append(new_track)
+                    print(f"    Fetched: {new_track['title']}")
+                    print(f"    Track URL: {new_track['track_url']}")
 
             # Save progress after each playlist
-            with open(output_file, "w") as f:
-                json.dump(all_tracks, f, indent=4)
+            with open(output_file, "wb") as f:
+                f.write(orjson.dumps(all_tracks, option=orjson.OPT_INDENT_2))
             print(f"Progress saved after playlist: {playlist.title}")
 
-        except Exception as e:
-            print(f"Error fetching playlist {playlist_url}: {e}")
-
     print(f"\nFinal database saved to {output_file}")
 
 
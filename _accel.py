@@ -0,0 +1,70 @@
+import librosa
+import numpy as np
+import pyfftw
+import pyfftw.interfaces.cache
+import pyfftw.interfaces.numpy_fft
+import pyfftw.interfaces.scipy_fft
+import scipy.fft
+from numba import njit
+
+
+def use_fftw(threads=1):
+    """
+    Route librosa's FFTs (STFT, CQT, onset and chroma features) through pyFFTW.
+
+    Args:
+        threads (int): Threads FFTW may use per transform.
+    """
+    pyfftw.config.NUM_THREADS = threads
+    pyfftw.interfaces.cache.enable()  # Keep FFTW plans between calls of the same size
+    librosa.set_fftlib(pyfftw.interfaces.numpy_fft)
+    scipy.fft.set_global_backend(pyfftw.interfaces.scipy_fft)
+
+
+
+@njit(cache=True, fastmath=True)
+def section_means(rms, frame_times, segment_times):
+    """
+    Compute the average RMS energy of each section.
+
+    Each section runs from its start time up to the next section's start time;
+    the last section ends at the last frame. End times are exclusive. Section
+    bounds come from one binary search over all section starts, since each
+    section ends where the next begins, and sums are accumulated in float64.
+
+    Args:
+        rms (np.ndarray): RMS energy per frame, contiguous float32.
+        frame_times (np.ndarray): Time of each frame in seconds, ascending, contiguous float32.
+        segment_times (np.ndarray): Section start times in seconds, ascending, float32.
+
+    Returns:
+        np.ndarray: Average energy of each section, 0.0 for empty sections.
+    """
+    n_frames = len(rms)
+    n_sections = len(segment_times)
+    means = np.zeros(n_sections)
+    if n_frames == 0:
+        return means
+
+    starts = np.searchsorted(frame_times, segment_times)
+    last_end = np.searchsorted(frame_times, frame_times[n_frames - 1])
+    for section in range(n_sections):
+        i0 = starts[section]
+        i1 = starts[section + 1] if section + 1 < n_sections else last_end
+        if i1 > i0:
+            for k in range(i0, i1):
+                means[section] += rms[k]
+            means[section] /= i1 - i0
+
+    return means
+
+
+def compile_kernels():
+    """
+    Compile the numba kernels once, writing them to numba's on-disk cache.
+
+    Call this before starting analysis worker processes so that they load the
+    cached kernels instead of each compiling them at the same time.
+    """
+    empty = np.zeros(1, dtype=np.float32)
+    section_means(empty, empty, empty)
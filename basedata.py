@@ -1,10 +1,9 @@
 from sclib import SoundcloudAPI
-import requests
 import librosa
 import numpy as np
-import io
 import matplotlib.pyplot as plt
 import time
+from pipeline import HOP_LENGTH, SESSION, decode_audio, request_headers
 
 
 # Initialize the SoundCloud API
@@ -27,14 +26,14 @@ print(f"Stream URL: {track.get_stream_url()}")
 
 # Stream the audio data from the URL
 stream_url = track.get_stream_url() # Replace with actual stream URL
-headers = {'User-Agent': 'Mozilla/5.0'}
-response = requests.get(stream_url, headers=headers, stream=True)
+headers = request_headers()
+response = SESSION.get(stream_url, headers=headers, stream=True)
 
-# Load the audio directly from the stream
-y, sr = librosa.load(io.BytesIO(response.content), sr=None)
+# Decode the audio directly from the stream
+y, sr = decode_audio(response.content)
 
 # Analyze the audio
-tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+tempo, _ = librosa.beat.beat_track(y=y, sr=sr, hop_length=HOP_LENGTH)
 print(f"Estimated BPM: {tempo}")
 print(f"Duration: {librosa.get_duration(y=y, sr=sr)} seconds")
 
@@ -1,10 +1,14 @@
-import json
+import asyncio
+import simdjson
 import librosa
 import numpy as np
-import requests
-import io
-import time
 from sclib import SoundcloudAPI
+from _accel import compile_kernels, section_means, use_fftw
+from pipeline import ANALYSIS_VERSION, HOP_LENGTH, decode_audio, load_progress, progress_path, run_pipeline, save_songs
+
+
+# Analysis runs one process per core, so each FFT gets a single thread
+use_fftw(threads=1)
 
 
 def extract_energy_by_section(y, sr, segment_times, frame_length=2048, hop_length=512):
@@ -21,74 +25,67 @@ def extract_energy_by_section(y, sr, segment_times, frame_length=2048, hop_lengt
     Returns:
         list: List of tuples (section_start_time, average_energy).
     """
-    # Calculate RMS energy for all frames
-    rms = librosa.feature.rms(y=y, frame_length=frame_length, hop_length=hop_length)[0]
+    # Calculate RMS energy for all frames, as a contiguous float32 array
+    rms = np.ascontiguousarray(librosa.feature.rms(y=y, frame_length=frame_length, hop_length=hop_length)[0], dtype=np.float32)
 
     # Map frame indices to time
-    frame_times = librosa.frames_to_time(range(len(rms)), sr=sr, hop_length=hop_length)
-
-    # Calculate average energy for each section
-    energy_by_section = []
-    for i, start_time in enumerate(segment_times):
-        # Determine the end of the section
-        end_time = segment_times[i + 1] if i < len(segment_times) - 1 else frame_times[-1]
+    frame_times = librosa.frames_to_time(np.arange(len(rms)), sr=sr, hop_length=hop_length).astype(np.float32)
 
-        # Get RMS values for frames within this section
-        section_indices = (frame_times >= start_time) & (frame_times < end_time)
-        section_energy = rms[section_indices]
+    # Average energy of each section, computed by the compiled kernel
+    section_starts = np.asarray(segment_times, dtype=np.float32)
+    average_energy = section_means(rms, frame_times, section_starts)
+    return list(zip(np.asarray(segment_times, dtype=float).tolist(), average_energy.tolist()))
 
-        # Compute average energy for the section
-        average_energy = float(np.mean(section_energy)) if len(section_energy) > 0 else 0.0
-        energy_by_section.append((float(start_time), average_energy))
 
-    return energy_by_section
 
-
-
-def extract_rhythm(y, sr):
+def extract_rhythm(y, sr, tempo, beat_frames, hop_length=HOP_LENGTH):
     """
     Extract rhythm features such as tempo and beat positions.
 
     Args:
         y (np.ndarray): Audio time-series.
         sr (int): Sample rate.
+        tempo (float): Estimated tempo from beat tracking.
+        beat_frames (np.ndarray): Beat positions in frames from beat tracking.
+        hop_length (int): Hop length used for beat tracking.
 
     Returns:
         dict: Tempo and beat times.
     """
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
-    beat_times = librosa.frames_to_time(beat_frames, sr=sr)
+    beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length)
     return {
         "tempo": float(tempo),  # Convert to native Python float
-        "beat_times": beat_times.tolist()
+        "beat_times": beat_times
     }
 
 
-def extract_structure(y, sr, num_sections=4):
+def extract_structure(y, sr, beat_frames, num_sections=4, hop_length=HOP_LENGTH, mel_db=None):
     """
     Analyze the structure of a song, identifying sections and bars.
 
     Args:
         y (np.ndarray): Audio time-series.
         sr (int): Sample rate.
+        beat_frames (np.ndarray): Beat positions in frames from beat tracking.
         num_sections (int): Number of desired sections.
+        hop_length (int): Hop length used for the MFCCs and beat tracking.
+        mel_db (np.ndarray): Precomputed log-power mel spectrogram, computed from y if omitted.
 
     Returns:
         dict: Section times and bar positions.
     """
     # Estimate structural boundaries using spectral features
-    mfcc = librosa.feature.mfcc(y=y, sr=sr)
+    mfcc = librosa.feature.mfcc(y=y, sr=sr, S=mel_db, hop_length=hop_length)
     boundaries = librosa.segment.agglomerative(mfcc.T, k=num_sections)
-    segment_times = librosa.frames_to_time(boundaries, sr=sr)
+    segment_times = librosa.frames_to_time(boundaries, sr=sr, hop_length=hop_length)
 
     # Estimate bar positions
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
     bar_length = 4  # Assuming 4 beats per bar
     bars = [beat_frames[i:i + bar_length] for i in range(0, len(beat_frames), bar_length)]
-    bar_times = [librosa.frames_to_time(bar, sr=sr).tolist() for bar in bars]
+    bar_times = [librosa.frames_to_time(bar, sr=sr, hop_length=hop_length) for bar in bars]
 
     return {
-        "sections": segment_times.tolist(),  # Convert NumPy array to list
+        "sections": segment_times,  # NumPy arrays are serialized directly by orjson
         "bars": bar_times
     }
 
@@ -104,8 +101,15 @@ def analyze_song_deep(y, sr):
     Returns:
         dict: Deep analysis data.
     """
-    structure = extract_structure(y, sr)
-    rhythm = extract_rhythm(y, sr)
+    # One log-mel spectrogram feeds both the onset envelope for beat tracking and the MFCCs
+    mel_db = librosa.power_to_db(librosa.feature.melspectrogram(y=y, sr=sr, hop_length=HOP_LENGTH))
+    onset_env = librosa.onset.onset_strength(S=mel_db, sr=sr, hop_length=HOP_LENGTH, aggregate=np.median)
+
+    # Beat tracking is shared by the rhythm and structure analysis
+    tempo, beat_frames = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=HOP_LENGTH)
+
+    structure = extract_structure(y, sr, beat_frames, mel_db=mel_db)
+    rhythm = extract_rhythm(y, sr, tempo, beat_frames)
     energy = extract_energy_by_section(y, sr, structure["sections"])
     return {
         "energy": energy,
@@ -114,17 +118,17 @@ def analyze_song_deep(y, sr):
     }
 
 
-def get_stream_url(track_url):
+def get_stream_url(track_url, api):
     """
     Resolve a track URL to get a fresh stream URL.
 
     Args:
         track_url (str): Permanent track URL.
+        api (SoundcloudAPI): Shared SoundCloud API client.
 
     Returns:
         str: Fresh stream URL or None if resolution fails.
     """
-    api = SoundcloudAPI()
     try:
         track = api.resolve(track_url)
         return track.get_stream_url()
@@ -133,6 +137,20 @@ def get_stream_url(track_url):
         return None
 
 
+def analyze_audio(data):
+    """
+    Decode downloaded audio and run the deep analysis on it.
+
+    Args:
+        data (bytes): Raw audio data.
+
+    Returns:
+        dict: Song fields to add, holding the deep analysis data.
+    """
+    y, sr = decode_audio(data)
+    return {"features": analyze_song_deep(y, sr)}
+
+
 def analyze_songs(input_file, output_file):
     """
     Analyze all songs in the cleaned_songs.json file and add deep analysis data.
@@ -142,56 +160,43 @@ def analyze_songs(input_file, output_file):
         output_file (str): Path to save the updated JSON file.
     """
     try:
-        # Load songs from the input JSON file
-        with open(input_file, "r") as f:
-            songs = json.load(f)
+        # Load songs from the input JSON file, materialized since analysis data is added to them
+        parser = simdjson.Parser()
+        with open(input_file, "rb") as f:
+            songs = parser.parse(f.read()).as_list()
     except FileNotFoundError:
         print(f"Error: {input_file} not found.")
         return
-    except json.JSONDecodeError:
+    except ValueError:
         print(f"Error: Failed to decode JSON from {input_file}.")
         return
 
-    for idx, song in enumerate(songs):
-        print(f"\nProcessing song {idx + 1}/{len(songs)}: {song.get('title', 'Unknown')} by {song.get('artist', 'Unknown')}")
-        track_url = song.get("track_url")
-        if not track_url:
-            print("  Skipping: No track URL available.")
-            continue
+    # Pick up songs analyzed by previous runs
+    progress_file = progress_path(output_file)
+    analyzed = load_progress(progress_file)
+    songs = [analyzed.get(song.get("track_url"), song) for song in songs]
 
-        # Get fresh stream URL
-        stream_url = get_stream_url(track_url)
-        if not stream_url:
-            print("  Skipping: Unable to resolve stream URL.")
+    pending = []
+    for song in songs:
+        if not song.get("track_url"):
+            print(f"Skipping song '{song.get('title', 'Unknown')}': No track URL available.")
             continue
+        if song.get("features") and song.get("analysis_version") == ANALYSIS_VERSION:
+            continue  # Already analyzed the current way, by a previous run or in the input file
+        pending.append(song)
 
-        try:
-            # Fetch audio data from stream URL
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            response = requests.get(stream_url, headers=headers, stream=True)
-            if response.status_code != 200:
-                print(f"  Skipping: Failed to fetch audio. Status Code: {response.status_code}")
-                continue
-
-            # Load audio data with librosa
-            y, sr = librosa.load(io.BytesIO(response.content), sr=None)
+    print(f"Analyzing {len(pending)}/{len(songs)} songs, the rest are already analyzed or have no track URL.")
 
-            # Perform deep analysis
-            deep_analysis = analyze_song_deep(y, sr)
-            song["features"] = deep_analysis
-            print("  Analysis complete. Added features.")
+    # Compile the energy kernel here so the analysis workers load it from numba's cache
+    compile_kernels()
 
-        except Exception as e:
-            print(f"  Error analyzing song: {e}")
-            continue
-
-        # Save progress incrementally
-        with open(output_file, "w") as f:
-            json.dump(songs, f, indent=4)
-        print(f"  Progress saved to {output_file}.")
+    # One client for the whole run, creating it scrapes a fresh client_id from SoundCloud
+    api = SoundcloudAPI()
+    asyncio.run(run_pipeline(pending, lambda track_url: get_stream_url(track_url, api), analyze_audio, progress_file))
 
-        # Add a small delay to avoid overwhelming the system
-        time.sleep(1)
+    # Consolidate everything into the final JSON file
+    save_songs(output_file, songs)
+    print(f"Analyzed songs saved to {output_file}.")
 
 
 if __name__ == "__main__":
@@ -1,10 +1,16 @@
-import json
+import asyncio
+import orjson
+import simdjson
 import sclib
 import librosa
-import requests
-import io
+import numpy as np
 from collections import defaultdict
-import time
+from _accel import use_fftw
+from pipeline import ANALYSIS_VERSION, EXCERPT_MAX_BYTES, HOP_LENGTH, decode_audio, load_progress, middle_excerpt, progress_path, run_pipeline, save_songs
+
+
+# Analysis runs one process per core, so each FFT gets a single thread
+use_fftw(threads=1)
 
 
 def sort_songs_by_genre(songs):
@@ -42,33 +48,33 @@ def get_stream_url(track_url, api):
         return None
 
 
-def analyze_song(stream_url):
+def analyze_song(data):
     """
     Analyze a song using librosa to extract BPM and key.
 
     Args:
-        stream_url (str): Stream URL of the song.
+        data (bytes): Raw audio data of the song.
 
     Returns:
         tuple: (BPM, Key) or (None, None) on failure.
     """
     try:
-        # Fetch the audio data
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(stream_url, headers=headers, stream=True)
+        # Decode the audio to a mono waveform
+        y, sr = decode_audio(data)
 
-        if response.status_code != 200:
-            print(f"Failed to fetch audio from {stream_url}. Status Code: {response.status_code}")
-            return None, None
+        # Estimate tempo and key from the middle minute of the first ~131 s that were downloaded
+        y = middle_excerpt(y, sr)
 
-        # Load the audio into librosa
-        y, sr = librosa.load(io.BytesIO(response.content), sr=None)
+        # One power spectrogram feeds both the tempo and the key analysis
+        S = np.abs(librosa.stft(y, hop_length=HOP_LENGTH)) ** 2
 
         # Analyze BPM (tempo)
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+        mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=S, sr=sr))
+        onset_env = librosa.onset.onset_strength(S=mel_db, sr=sr, hop_length=HOP_LENGTH, aggregate=np.median)
+        tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=HOP_LENGTH)
 
         # Analyze key using chroma features
-        chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
+        chroma = librosa.feature.chroma_stft(S=S, sr=sr)
         key_index = chroma.mean(axis=1).argmax()
 
         # Map the key index to musical notes
@@ -83,6 +89,22 @@ def analyze_song(stream_url):
         return None, None
 
 
+def analyze_audio(data):
+    """
+    Extract BPM and key from downloaded audio.
+
+    Args:
+        data (bytes): Raw audio data of the song.
+
+    Returns:
+        dict: Song fields to add, or None on failure.
+    """
+    bpm, key = analyze_song(data)
+    if bpm and key:
+        return {"bpm": bpm, "key": key}  # BPM as a float, key as a string
+    return None
+
+
 def process_songs(input_file, output_file):
     """
     Sort songs by genre, analyze each song for BPM and key, and save the updated data.
@@ -91,56 +113,49 @@ def process_songs(input_file, output_file):
         input_file (str): Path to the input JSON file.
         output_file (str): Path to the output JSON file.
     """
-    api = sclib.SoundcloudAPI()
-
-    # Load songs from the input JSON file
+    # Load songs from the input JSON file, materialized since analysis data is added to them
     try:
-        with open(input_file, "r") as f:
-            songs = json.load(f)
+        parser = simdjson.Parser()
+        with open(input_file, "rb") as f:
+            songs = parser.parse(f.read()).as_list()
     except FileNotFoundError:
         print(f"Error: {input_file} not found.")
         return
-    except json.JSONDecodeError:
+    except ValueError:
         print(f"Error: Failed to decode JSON from {input_file}.")
         return
 
+    # Pick up songs analyzed by previous runs
+    progress_file = progress_path(output_file)
+    analyzed = load_progress(progress_file)
+    songs = [analyzed.get(song.get("track_url"), song) for song in songs]
+
     # Sort songs by genre
     sorted_songs = sort_songs_by_genre(songs)
 
-    # Analyze each song
+    # Queue songs genre by genre
+    pending = []
     for genre, genre_songs in sorted_songs.items():
-        print(f"\nProcessing genre: {genre} with {len(genre_songs)} songs.")
+        print(f"\nQueueing genre: {genre} with {len(genre_songs)} songs.")
 
         for song in genre_songs:
-            track_url = song.get("track_url")
-            if not track_url:
+            if not song.get("track_url"):
                 print(f"Skipping song '{song.get('title', 'Unknown')}' (no track URL).")
                 continue
+            if "bpm" in song and "key" in song and song.get("analysis_version") == ANALYSIS_VERSION:
+                continue  # Already analyzed the current way, by a previous run or in the input file
+            pending.append(song)
 
-            print(f"  Analyzing: {song.get('title', 'Unknown')} by {song.get('artist', 'Unknown')}")
-
-            # Get a fresh stream URL
-            stream_url = get_stream_url(track_url, api)
-            if not stream_url:
-                print(f"  Skipping song: Unable to resolve stream URL.")
-                continue
-
-            # Analyze the song
-            bpm, key = analyze_song(stream_url)
-            if bpm and key:
-                song["bpm"] = bpm  # Store BPM as a float
-                song["key"] = key  # Store key as a string
-                print(f"    Extracted BPM: {bpm}, Key: {key}")
-            else:
-                print(f"    Failed to analyze the song.")
-
-            # Save progress incrementally
-            with open(output_file, "w") as f:
-                json.dump(songs, f, indent=4)
-            print(f"    Progress saved to {output_file}.")
+    # Analyze each song, only downloading the start of it since BPM and key use an excerpt
+    api = sclib.SoundcloudAPI()
+    asyncio.run(run_pipeline(
+        pending, lambda track_url: get_stream_url(track_url, api), analyze_audio, progress_file,
+        max_bytes=EXCERPT_MAX_BYTES
+    ))
 
-            # Add a small delay to avoid overwhelming the system or API
-            time.sleep(1)
+    # Consolidate everything into the final JSON file
+    save_songs(output_file, songs)
+    print(f"Analyzed songs saved to {output_file}.")
 
 
 def clean_analyzed_songs(input_file, output_file):
@@ -152,23 +167,24 @@ def clean_analyzed_songs(input_file, output_file):
         output_file (str): Path to save the cleaned JSON file.
     """
     try:
-        # Load the JSON file
-        with open(input_file, "r") as f:
-            songs = json.load(f)
+        # Load the JSON file; only the bpm and key fields are inspected, so keep it lazy
+        parser = simdjson.Parser()
+        with open(input_file, "rb") as f:
+            songs = parser.parse(f.read())
     except FileNotFoundError:
         print(f"Error: {input_file} not found.")
         return
-    except json.JSONDecodeError:
+    except ValueError:
         print(f"Error: Failed to decode JSON from {input_file}.")
         return
 
     # Filter songs with both BPM and key
-    cleaned_songs = [song for song in songs if "bpm" in song and "key" in song]
+    cleaned_songs = [song.as_dict() for song in songs if "bpm" in song and "key" in song]
 
     # Save the cleaned data
     try:
-        with open(output_file, "w") as f:
-            json.dump(cleaned_songs, f, indent=4)
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(cleaned_songs, option=orjson.OPT_INDENT_2))
         print(f"Cleaned data saved to {output_file}. Removed {len(songs) - len(cleaned_songs)} incomplete songs.")
     except Exception as e:
         print(f"Error saving cleaned JSON file: {e}")
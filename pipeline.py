@@ -0,0 +1,453 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+import aiohttp
+import numpy as np
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Maximum number of audio downloads in flight at once
+MAX_CONCURRENT_DOWNLOADS = 10
+
+# Number of songs analyzed in parallel, one process each
+ANALYSIS_WORKERS = os.cpu_count() or 1
+
+# Downloaded songs waiting for analysis; bounds how much audio is held in memory
+AUDIO_QUEUE_SIZE = 2 * ANALYSIS_WORKERS
+
+# Stored with every analyzed song; bump it whenever the analysis changes so that
+# songs analyzed the old way are redone. Unversioned results predate version 2.
+ANALYSIS_VERSION = 2
+
+# Sample rate audio is decoded to for analysis
+SAMPLE_RATE = 22050
+
+# Hop length for beat tracking, chroma and structure features
+HOP_LENGTH = 1024
+
+# BPM and key are estimated from an excerpt of this many seconds, centered in the decoded audio
+EXCERPT_DURATION = 60
+
+# Audio shorter than this many seconds is analyzed in full. This is compared against
+# the decoded audio, which for BPM and key is only the first EXCERPT_MAX_BYTES of the track.
+MIN_EXCERPT_TRACK_DURATION = 90
+
+# Bytes downloaded when only an excerpt is needed, about 131 seconds of 128 kbps MP3
+EXCERPT_MAX_BYTES = 2 * 1024 * 1024
+
+# Downloaded audio is cached on disk, keyed by permanent track URL
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "soundanalysis")
+CACHE_TTL = 30 * 24 * 60 * 60  # Seconds before a cached download is fetched again
+
+# Pooled connections per HTTP session, enough for every concurrent download
+MAX_CONNECTIONS = 32
+
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+
+# Shared blocking HTTP session, reusing keep-alive connections instead of a new TLS handshake per request
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MAX_CONNECTIONS, pool_maxsize=MAX_CONNECTIONS,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+))
+
+
+def decode_audio(data, sr=SAMPLE_RATE):
+    """
+    Decode compressed audio to a mono waveform by piping it through ffmpeg.
+
+    Args:
+        data (bytes): Raw audio data, e.g. an MP3 stream.
+        sr (int): Sample rate to resample to.
+
+    Returns:
+        tuple: (y, sr) with y as a float32 np.ndarray.
+    """
+    process = subprocess.Popen(
+        ["ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-f", "f32le", "-ac", "1", "-ar", str(sr), "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    raw, error = process.communicate(data)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode audio: {error.decode(errors='replace').strip()}")
+    return np.frombuffer(raw, dtype=np.float32), sr
+
+
+def middle_excerpt(y, sr, duration=EXCERPT_DURATION, min_track_duration=MIN_EXCERPT_TRACK_DURATION):
+    """
+    Cut an excerpt out of the middle of the given audio.
+
+    The excerpt is centered in y, not in the original track. When y is a
+    range-limited download (EXCERPT_MAX_BYTES, about the first 131 seconds),
+    the excerpt covers roughly 35 to 95 seconds into the track.
+
+    Args:
+        y (np.ndarray): Audio time-series, possibly only the start of a track.
+        sr (int): Sample rate.
+        duration (float): Excerpt length in seconds.
+        min_track_duration (float): Audio shorter than this, measured on y, is returned whole.
+
+    Returns:
+        np.ndarray: Excerpt of the audio time-series.
+    """
+    if len(y) < min_track_duration * sr:
+        return y
+
+    length = int(duration * sr)
+    start = (len(y) - length) // 2
+    return y[start:start + length]
+
+
+def request_headers(max_bytes=None):
+    """
+    Build the headers for an audio request.
+
+    Args:
+        max_bytes (int): Only request the first max_bytes bytes, or everything if None.
+
+    Returns:
+        dict: Request headers, a new dict the caller may modify.
+    """
+    if max_bytes is None:
+        return dict(HEADERS)
+    return {**HEADERS, 'Range': f"bytes=0-{max_bytes - 1}"}
+
+
+async def fetch(session, url, max_bytes=None):
+    """
+    Fetch the raw audio bytes behind a stream URL.
+
+    Args:
+        session (aiohttp.ClientSession): Open HTTP session.
+        url (str): Stream URL of the song.
+        max_bytes (int): Only fetch the first max_bytes bytes, or everything if None.
+
+    Returns:
+        bytes: Audio data or None if the request fails.
+    """
+    try:
+        async with session.get(url, headers=request_headers(max_bytes)) as response:
+            # 206 Partial Content answers a range request
+            if response.status not in (200, 206):
+                print(f"  Failed to fetch audio from {url}. Status Code: {response.status}")
+                return None
+            return await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"  Error fetching audio from {url}: {e}")
+        return None
+
+
+def cache_path(track_url, max_bytes=None):
+    """
+    Get the cache file path for a track.
+
+    Args:
+        track_url (str): Permanent track URL.
+        max_bytes (int): Download size limit, partial downloads are cached separately.
+
+    Returns:
+        str: Path of the cached audio file.
+    """
+    key = track_url if max_bytes is None else f"{track_url}#bytes=0-{max_bytes - 1}"
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".mp3")
+
+
+def read_cache(track_url, max_bytes=None):
+    """
+    Read a track's audio from the cache.
+
+    Args:
+        track_url (str): Permanent track URL.
+        max_bytes (int): Download size limit the audio was fetched with.
+
+    Returns:
+        bytes: Cached audio data or None if missing or older than CACHE_TTL.
+    """
+    path = cache_path(track_url, max_bytes)
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_TTL:
+            os.remove(path)
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def prune_cache():
+    """
+    Delete cached downloads older than CACHE_TTL, including leftover temporary files.
+    """
+    now = time.time()
+    try:
+        entries = os.scandir(CACHE_DIR)
+    except FileNotFoundError:
+        return
+
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime > CACHE_TTL:
+                    os.remove(entry.path)
+            except OSError as e:
+                print(f"  Failed to remove expired cache entry {entry.path}: {e}")
+
+
+def write_cache(track_url, data, max_bytes=None):
+    """
+    Store a track's audio in the cache.
+
+    Args:
+        track_url (str): Permanent track URL.
+        data (bytes): Audio data.
+        max_bytes (int): Download size limit the audio was fetched with.
+    """
+    path = cache_path(track_url, max_bytes)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+        # Write to a temporary file first so an interrupted run never leaves a truncated entry
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"  Failed to cache audio for {track_url}: {e}")
+
+
+async def fetch_cached(session, track_url, resolve_stream_url, max_bytes=None):
+    """
+    Get a track's audio from the cache, downloading and caching it on a miss.
+
+    Args:
+        session (aiohttp.ClientSession): Open HTTP session.
+        track_url (str): Permanent track URL.
+        resolve_stream_url (callable): Blocking function mapping a track URL to a stream URL.
+        max_bytes (int): Only fetch the first max_bytes bytes, or everything if None.
+
+    Returns:
+        bytes: Audio data or None if it could not be downloaded.
+    """
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, read_cache, track_url, max_bytes)
+    if data is not None:
+        return data
+
+    # sclib is blocking, so keep it off the event loop
+    stream_url = await loop.run_in_executor(None, resolve_stream_url, track_url)
+    if not stream_url:
+        print(f"  Unable to resolve stream URL for {track_url}.")
+        return None
+
+    data = await fetch(session, stream_url, max_bytes)
+    if data is not None:
+        await loop.run_in_executor(None, write_cache, track_url, data, max_bytes)
+    return data
+
+
+def progress_path(output_file):
+    """
+    Get the JSONL progress file that goes with an output JSON file.
+
+    Args:
+        output_file (str): Path of the final JSON file.
+
+    Returns:
+        str: Path of the progress file, e.g. songs.json -> songs.jsonl.
+    """
+    return os.path.splitext(output_file)[0] + ".jsonl"
+
+
+def load_progress(progress_file):
+    """
+    Load songs analyzed by previous runs from a JSONL progress file.
+
+    A partial last line left by an interrupted run is truncated away, so the
+    next append starts on a fresh line.
+
+    Args:
+        progress_file (str): Path to the progress file.
+
+    Returns:
+        dict: Analyzed songs keyed by track URL.
+    """
+    analyzed = {}
+    complete_end = 0  # Offset just past the last complete line
+    try:
+        with open(progress_file, "r+b") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Partial last line from an interrupted run
+                complete_end += len(line)
+                try:
+                    song = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # Skip a corrupt record rather than the whole file
+                analyzed[song["track_url"]] = song
+
+            # Drop the partial line so the next append starts on a fresh line
+            f.seek(0, os.SEEK_END)
+            if f.tell() > complete_end:
+                f.truncate(complete_end)
+    except FileNotFoundError:
+        pass
+    return analyzed
+
+
+def append_progress(progress_file, song):
+    """
+    Stamp an analyzed song with ANALYSIS_VERSION and append it to a JSONL progress file.
+
+    Args:
+        progress_file (str): Path to the progress file.
+        song (dict): Analyzed song, updated in place with its analysis version.
+    """
+    song["analysis_version"] = ANALYSIS_VERSION
+    with open(progress_file, "ab") as f:
+        f.write(orjson.dumps(song, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n")
+
+
+def save_songs(output_file, songs):
+    """
+    Write the consolidated list of songs to a JSON file.
+
+    Args:
+        output_file (str): Path to the output JSON file.
+        songs (list): Songs to save.
+    """
+    with open(output_file, "wb") as f:
+        f.write(orjson.dumps(songs, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+
+
+async def download_worker(session, pending, resolve_stream_url, audio_queue, max_bytes=None):
+    """
+    Download songs from the shared pending iterator and queue them for analysis.
+
+    Args:
+        session (aiohttp.ClientSession): Open HTTP session.
+        pending (iterator): Songs still to download, shared between workers.
+        resolve_stream_url (callable): Blocking function mapping a track URL to a stream URL.
+        audio_queue (asyncio.Queue): Queue of (song, audio data) pairs.
+        max_bytes (int): Only fetch the first max_bytes bytes of each song, or everything if None.
+    """
+    for song in pending:
+        title = song.get('title', 'Unknown')
+
+        data = await fetch_cached(session, song["track_url"], resolve_stream_url, max_bytes)
+        if data is None:
+            print(f"  Skipping '{title}': Failed to fetch audio.")
+            continue
+
+        print(f"  Downloaded: {title} by {song.get('artist', 'Unknown')}")
+        await audio_queue.put((song, data))
+
+
+async def analysis_worker(executor, analyze, audio_queue, result_queue):
+    """
+    Run the analysis on downloaded songs until a None sentinel is received.
+
+    Args:
+        executor (concurrent.futures.Executor): Executor the CPU-bound analysis runs in.
+        analyze (callable): Picklable function mapping audio data to a dict of fields to add
+            to the song, or None.
+        audio_queue (asyncio.Queue): Queue of (song, audio data) pairs.
+        result_queue (asyncio.Queue): Queue of (song, fields) pairs.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await audio_queue.get()
+        if item is None:
+            return
+
+        song, data = item
+        try:
+            fields = await loop.run_in_executor(executor, analyze, data)
+        except Exception as e:
+            print(f"  Error analyzing song '{song.get('title', 'Unknown')}': {e}")
+            fields = None
+        await result_queue.put((song, fields))
+
+
+async def writer(progress_file, result_queue):
+    """
+    Apply analysis results to songs and append them to the progress file.
+
+    Args:
+        progress_file (str): Path to the JSONL progress file.
+        result_queue (asyncio.Queue): Queue of (song, fields) pairs, ended by a None sentinel.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await result_queue.get()
+        if item is None:
+            return
+
+        song, fields = item
+        if not fields:
+            print(f"    Failed to analyze '{song.get('title', 'Unknown')}'.")
+            continue
+
+        song.update(fields)
+        print(f"    Analysis complete: {song.get('title', 'Unknown')}")
+
+        # Only the new song is written, earlier results are never re-encoded
+        await loop.run_in_executor(None, append_progress, progress_file, song)
+
+
+async def run_pipeline(songs, resolve_stream_url, analyze, progress_file, max_bytes=None):
+    """
+    Download and analyze songs, overlapping network and CPU work.
+
+    Download workers feed a bounded queue of audio, analysis workers drain it
+    into a process pool, and a single writer applies the results and appends each
+    analyzed song to a JSONL progress file.
+    Only the compressed audio bytes are sent to the worker processes, which
+    decode the audio themselves.
+
+    Args:
+        songs (list): Songs to process, each with a "track_url".
+        resolve_stream_url (callable): Blocking function mapping a track URL to a stream URL.
+        analyze (callable): Picklable module-level function mapping audio data to a dict
+            of fields to add to the song, or None.
+        progress_file (str): Path to the JSONL progress file.
+        max_bytes (int): Only fetch the first max_bytes bytes of each song, or everything if None.
+    """
+    # Expired downloads would otherwise stay on disk forever
+    await asyncio.get_running_loop().run_in_executor(None, prune_cache)
+
+    audio_queue = asyncio.Queue(maxsize=AUDIO_QUEUE_SIZE)
+    result_queue = asyncio.Queue()
+    pending = iter(songs)
+
+    # Workers start lazily while the default thread pool is busy; forking then could
+    # leave them holding locks owned by those threads, so start them from a forkserver,
+    # or spawn them where forkserver is unavailable (Windows)
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    mp_context = multiprocessing.get_context(start_method)
+    with ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS, mp_context=mp_context) as executor:
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            writer_task = asyncio.create_task(writer(progress_file, result_queue))
+            analysis_tasks = [
+                asyncio.create_task(analysis_worker(executor, analyze, audio_queue, result_queue))
+                for _ in range(ANALYSIS_WORKERS)
+            ]
+
+            await asyncio.gather(*(
+                download_worker(session, pending, resolve_stream_url, audio_queue, max_bytes)
+                for _ in range(MAX_CONCURRENT_DOWNLOADS)
+            ))
+
+            # Downloads are done; stop the analysis workers, then the writer
+            for _ in analysis_tasks:
+                await audio_queue.put(None)
+            await asyncio.gather(*analysis_tasks)
+            await result_queue.put(None)
+            await writer_task
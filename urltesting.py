@@ -1,7 +1,6 @@
 from sclib import SoundcloudAPI
-import requests
 import librosa
-import io
+from pipeline import EXCERPT_MAX_BYTES, HOP_LENGTH, SESSION, decode_audio, middle_excerpt, request_headers
 
 
 def test_soundcloud_url(track_url):
@@ -21,8 +20,8 @@ def test_soundcloud_url(track_url):
         print(f"Stream URL: {stream_url}")
 
         # Validate the streaming URL
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.head(stream_url, headers=headers)
+        headers = request_headers()
+        response = SESSION.head(stream_url, headers=headers)
 
         if response.status_code == 200:
             print("Stream URL is valid and accessible.")
@@ -47,22 +46,26 @@ def analyze_song_bpm_and_key(stream_url):
         tuple: (BPM, Key) if successful, or (None, None) on failure.
     """
     try:
-        # Fetch the audio data
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(stream_url, headers=headers, stream=True)
+        # Fetch the start of the audio data, BPM and key only need an excerpt
+        headers = request_headers(EXCERPT_MAX_BYTES)
+        response = SESSION.get(stream_url, headers=headers, stream=True)
 
-        if response.status_code != 200:
+        # 206 Partial Content answers the range request
+        if response.status_code not in (200, 206):
             print(f"Failed to fetch audio from {stream_url}. Status Code: {response.status_code}")
             return None, None
 
-        # Load the audio data into librosa
-        y, sr = librosa.load(io.BytesIO(response.content), sr=None)
+        # Decode the audio data to a mono waveform
+        y, sr = decode_audio(response.content)
+
+        # Estimate tempo and key from the middle minute of the first ~131 s that were downloaded
+        y = middle_excerpt(y, sr)
 
         # Analyze BPM (tempo)
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+        tempo, _ = librosa.beat.beat_track(y=y, sr=sr, hop_length=HOP_LENGTH)
 
         # Analyze key using chroma features
-        chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
+        chroma = librosa.feature.chroma_stft(y=y, sr=sr, hop_length=HOP_LENGTH)
         key_index = chroma.mean(axis=1).argmax()
 
         # Map the key index to musical notes